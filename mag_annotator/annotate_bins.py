@@ -44,6 +44,7 @@ MAG_DBS_TO_ANNOTATE = (
     "dbcan",
     "vogdb",
 )
+CAZY_FAMILY_REGEX = re.compile(r"^[A-Z]*[0-9]*")
 
 # TODO: Bind verbose to logging
 # TODO Exceptions are not fully handled by logging
@@ -308,7 +309,7 @@ def dbcan_hmmscan_formater(hits: pd.DataFrame, db_name: str, db_handler=None):
     hits_df.columns = [f"{db_name}_ids"]
 
     def description_pull(x: str):
-        id_list = ([re.findall("^[A-Z]*[0-9]*", str(x))[0] for x in x.split("; ")],)
+        id_list = ([CAZY_FAMILY_REGEX.match(str(x)).group() for x in x.split("; ")],)
         id_list = [y for x in id_list for y in x if len(x) > 0]
         description_list = db_handler.get_descriptions(
             id_list, "dbcan_description"
@@ -14,7 +14,7 @@ from skbio.io import write as write_sequence
 from mag_annotator.database_handler import DatabaseHandler
 from mag_annotator.annotate_bins import annotate_fastas, get_fasta_name, perform_fasta_checks
 from mag_annotator.utils import setup_logger
-from mag_annotator.summarize_genomes import get_ids_from_annotations_all
+from mag_annotator.summarize_genomes import get_ids_from_annotations_by_row, PFAM_REGEX
 
 VMAG_DBS_TO_ANNOTATE = ('kegg', 'kofam_hmm', 'kofam_ko_list', 'uniref', 'peptidase', 'pfam', 'dbcan', 'viral', 'vogdb')
 VIRSORTER_COLUMN_NAMES = ['gene_name', 'start_position', 'end_position', 'length', 'strandedness',
@@ -176,7 +176,7 @@ def is_transposon(pfam_hits):
     if pd.isna(pfam_hits):
         return False
     else:
-        pfams = {i[1:-1].split('.')[0] for i in re.findall(r'\[PF\d\d\d\d\d.\d*\]', pfam_hits)}
+        pfams = set(PFAM_REGEX.findall(pfam_hits))
         return len(pfams & TRANSPOSON_PFAMS) > 0
 
 
@@ -287,11 +287,12 @@ def get_metabolic_flags(annotations, metabolic_genes, amgs, verified_amgs, scaff
                         logger, length_from_end=5000):
     flag_dict = dict()
     metabolic_genes = set(metabolic_genes)
+    gene_ids = get_ids_from_annotations_by_row(annotations).to_dict()
     for scaffold, scaffold_annotations in annotations.groupby('scaffold'):
         for gene, row in scaffold_annotations.iterrows():
             # set up
             flags = ''
-            gene_annotations = set(get_ids_from_annotations_all(pd.DataFrame(row).transpose()).keys())  # TODO: Fix
+            gene_annotations = gene_ids[gene]
             # is viral
             if 'vogdb_categories' in row.index and not pd.isna(row['vogdb_categories']):
                 if len({'Xr', 'Xs'} & set(row['vogdb_categories'].split(';'))) > 0:
@@ -14,7 +14,7 @@ from skbio import read as read_sequence
 from skbio import write as write_sequence
 
 from mag_annotator.database_handler import DatabaseHandler
-from mag_annotator.utils import run_process, make_mmseqs_db, download_file, merge_files, remove_prefix, remove_suffix, setup_logger
+from mag_annotator.utils import run_process, make_mmseqs_db, download_file, download_files, merge_files, remove_prefix, remove_suffix, setup_logger
 
 NUMBER_OF_VIRAL_FILES = 2
 DEFAULT_DBCAN_RELEASE = '11'
@@ -258,12 +258,14 @@ def download_viral(output_dir='.', logger=LOGGER, viral_files=NUMBER_OF_VIRAL_FI
     # TODO: Make it so that you don't need to know number of viral files in refseq viral
     faa_base_name = 'viral.%s.protein.faa.gz'
     viral_faa_glob = path.join(output_dir, faa_base_name % '*')
+    downloads = list()
     for number in range(viral_files):
         number += 1
         url = 'ftp://ftp.ncbi.nlm.nih.gov/refseq/release/viral/viral.%s.protein.faa.gz' % number
         url_http = 'https://ftp.ncbi.nlm.nih.gov/refseq/release/viral/viral.%s.protein.faa.gz' % number
         output_name= path.join(output_dir, faa_base_name % number)
-        download_file(url, output_name, logger, alt_urls=[url_http], verbose=verbose)
+        downloads.append((url, output_name, [url_http]))
+    download_files(downloads, logger, verbose=verbose)
     # then merge files from above
     merged_viral_faas = path.join(output_dir, 'viral.merged.protein.faa.gz')
     run_process(['cat %s > %s' % (' '.join(glob(viral_faa_glob)), merged_viral_faas)], logger, shell=True)
@@ -298,7 +300,8 @@ def download_vogdb(output_dir='.', logger=LOGGER, version=DEFAULT_VOGDB_VERSION,
 def process_kofam_ko_list(kofam_ko_list_gz, output_dir='.', logger=LOGGER, threads=1, verbose=False):
     # TODO: fix this so that it is gunzipped to the path
     kofam_ko_list = path.join(output_dir, 'kofam_ko_list.tsv')
-    run_process(['gunzip', '-c', kofam_ko_list_gz], logger, save_output=kofam_ko_list, verbose=verbose)
+    run_process(['gunzip', '-c', kofam_ko_list_gz], logger, capture_stdout=False, save_output=kofam_ko_list,
+                verbose=verbose)
     LOGGER.info('KOfam ko list processed')
     return {'kofam_ko_list': kofam_ko_list}
 
@@ -515,7 +518,7 @@ def prepare_databases(output_dir, loggpath=None, kegg_loc=None, gene_ko_link_loc
     temporary = path.join(output_dir, 'database_files')
     mkdir(temporary)
     main_log = path.join(output_dir, 'database_processing.log')
-    setup_logger(LOGGER, *[(main_log, loggpath) if loggpath is not None else main_log])
+    setup_logger(LOGGER, *([main_log, loggpath] if loggpath is not None else [main_log]))
     db_handler = DatabaseHandler(logger=LOGGER)
     if clear_config or select_db is None:
         db_handler.clear_config()
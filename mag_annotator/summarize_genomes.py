@@ -1,7 +1,6 @@
 """This is the script that distills the genomes"""
 import logging
 from collections import Counter
-from itertools import chain
 import pandas as pd
 from collections import Counter, defaultdict
 from os import path, mkdir
@@ -26,6 +25,8 @@ HEATMAP_MODULES = ['M00001', 'M00004', 'M00008', 'M00009', 'M00012', 'M00165', '
 HEATMAP_CELL_HEIGHT = 10
 HEATMAP_CELL_WIDTH = 10
 KO_REGEX = r'^K\d\d\d\d\d$'
+EC_REGEX = re.compile(r'\[(EC:\d+(?:\.\d+){3})\]')
+PFAM_REGEX = re.compile(r'\[(PF\d{5})\.\d*\]')
 ETC_COVERAGE_COLUMNS = ['module_id', 'module_name', 'complex', 'genome', 'path_length',
                         'path_length_coverage', 'percent_coverage', 'genes', 'missing_genes',
                         'complex_module_name']
@@ -35,20 +36,26 @@ CONSTANT_DISTILLATE_COLUMNS = [COL_GENE_ID, COL_GENE_DESCRIPTION, COL_MODULE, CO
 DISTILATE_SORT_ORDER_COLUMNS = [COL_HEADER, COL_SUBHEADER, COL_MODULE, COL_GENE_ID]
 EXCEL_MAX_CELL_SIZE = 32767
 
+
+def find_all_matches(data, regex, literal):
+    """Find every regex match in a series, only values containing the literal start of the match are searched
+    With a capture group in the regex only the captured text is returned
+    """
+    return data[data.str.contains(literal, regex=False)].str.findall(regex).explode()
+
+
 ID_FUNCTION_DICT = {
-    'kegg_genes_id': lambda x: [x],
-    'ko_id': lambda x: [j for j in x.split(',')],
-    'kegg_id': lambda x: [j for j in x.split(',')],
-    'kegg_hit': lambda x: [i[1:-1] for i in
-                           re.findall(r'\[EC:\d*.\d*.\d*.\d*\]', x)],
-    'peptidase_family': lambda x: [j for j in x.split(';')],
-    'cazy_best_hit': lambda x: [x.split('_')[0]],
-    'pfam_hits': lambda x: [j[1:-1].split('.')[0]
-                            for j in re.findall(r'\[PF\d\d\d\d\d.\d*\]', x)],
-    'camper_id': lambda x: [x],
-    'fegenie_id': lambda x: [x],
-    'sulfur_id': lambda x: [x],
-    'methyl_id': lambda x: [i.split(' ')[0].strip() for i in x.split(',')]
+    'kegg_genes_id': lambda x: x,
+    'ko_id': lambda x: x.str.split(',').explode(),
+    'kegg_id': lambda x: x.str.split(',').explode(),
+    'kegg_hit': lambda x: find_all_matches(x, EC_REGEX, '[EC:'),
+    'peptidase_family': lambda x: x.str.split(';').explode(),
+    'cazy_best_hit': lambda x: x.str.split('_').str[0],
+    'pfam_hits': lambda x: find_all_matches(x, PFAM_REGEX, '[PF'),
+    'camper_id': lambda x: x,
+    'fegenie_id': lambda x: x,
+    'sulfur_id': lambda x: x,
+    'methyl_id': lambda x: x.str.split(',').explode().str.split(' ').str[0].str.strip()
 }
 
 
@@ -60,24 +67,48 @@ def check_columns(data, logger):
           f" but these are {list(functions.keys())}")
 
 
-def get_ids_from_annotations_by_row(data):
+def apply_id_function(values, function):
+    """Run an id function once per distinct value, then give the ids to every row with that value"""
+    codes, uniques = pd.factorize(values)
+    ids = function(pd.Series(uniques, dtype=object)).dropna()
+    rows = pd.DataFrame({'row': values.index}, index=codes).join(ids.rename('id'), how='inner')
+    return pd.Series(rows['id'].to_numpy(), index=rows['row'].to_numpy(), dtype=object)
+
+
+def get_ids_from_annotations_long(data):
+    """Get all ids from the annotations as one series indexed by row position, each id appears once per row"""
     functions = {i:j for i,j in ID_FUNCTION_DICT.items() if i in data.columns}
-    out = data.apply(lambda x: {i for k, v in functions.items() if not pd.isna(x[k])
-                          for i in v(str(x[k])) if not pd.isna(i)}, axis=1)
-    return out
+    data = data.reset_index(drop=True)
+    ids = [apply_id_function(data[k].dropna().astype(str), v) for k, v in functions.items()]
+    if len(ids) == 0:
+        return pd.Series(dtype=object)
+    ids = pd.concat(ids).dropna()
+    return ids[~ids.reset_index().duplicated().values]
+
+
+def get_ids_from_annotations_by_row(data):
+    row_ids = get_ids_from_annotations_long(data).groupby(level=0).agg(set).reindex(range(len(data)))
+    return pd.Series([i if isinstance(i, set) else set() for i in row_ids], index=data.index, dtype=object)
 
 
 def get_ids_from_annotations_all(data):
-    data =  get_ids_from_annotations_by_row(data)
-    data.apply(list)
-    out = Counter(chain(*data.values))
-    return out
+    # Counter counts a list in C, value_counts is no faster once its result is turned back into a Counter
+    return Counter(get_ids_from_annotations_long(data).tolist())
+
+
+def get_ids_from_annotations_by_group(data, groupby_column):
+    """Count the ids in each group of the annotations, extracting the ids from the whole frame in one pass"""
+    ids = get_ids_from_annotations_long(data)
+    groups = data[groupby_column].to_numpy()
+    group_ids = {group: Counter() for group in get_ordered_uniques(data[groupby_column])}
+    for group, frame in ids.groupby(groups[ids.index.to_numpy()]):
+        group_ids[group] = Counter(frame.tolist())
+    return group_ids
 
 
 def fill_genome_summary_frame(annotations, genome_summary_frame, groupby_column, logger):
     genome_summary_id_sets = [set([str(k).strip() for k in j.split(',')]) for j in genome_summary_frame['gene_id']]
-    def fill_a_frame(frame:pd.DataFrame):
-        id_dict = get_ids_from_annotations_all(frame)
+    def fill_a_frame(id_dict:Counter):
         counts = list()
         for i in genome_summary_id_sets:
             identifier_count = 0
@@ -85,19 +116,21 @@ def fill_genome_summary_frame(annotations, genome_summary_frame, groupby_column,
                 if j in id_dict:
                     identifier_count += id_dict[j]
             counts.append(identifier_count)
-        return pd.Series(counts, index=genome_summary_frame.index)
-        # genome_summary_frame[genome] = counts
-    counts = annotations.groupby(groupby_column, sort=False).apply(fill_a_frame)
-    genome_summary_frame = pd.concat([genome_summary_frame, counts.T], axis=1)
+        return counts
+    counts = pd.DataFrame({genome: fill_a_frame(id_dict) for genome, id_dict in
+                           get_ids_from_annotations_by_group(annotations, groupby_column).items()},
+                          index=genome_summary_frame.index)
+    genome_summary_frame = pd.concat([genome_summary_frame, counts], axis=1)
     return genome_summary_frame
 
 
 def fill_genome_summary_frame_gene_names(annotations, genome_summary_frame, groupby_column, logger):
     genome_summary_id_sets = [set([k.strip() for k in j.split(',')]) for j in genome_summary_frame['gene_id']]
-    for genome, frame in annotations.groupby(groupby_column, sort=False):
+    row_ids = get_ids_from_annotations_by_row(annotations)
+    for genome, frame_ids in row_ids.groupby(annotations[groupby_column].to_numpy(), sort=False):
         # make dict of identifiers to gene names
         id_gene_dict = defaultdict(list)
-        for gene, ids in get_ids_from_annotations_by_row(frame).iteritems():
+        for gene, ids in frame_ids.items():
             for id_ in ids:
                 id_gene_dict[id_].append(gene)
         # fill in genome summary_frame
@@ -443,6 +476,7 @@ def get_module_coverage(module_net: nx.DiGraph, genes_present: set):
 
 def make_etc_coverage_df(etc_module_df, annotations, groupby_column='fasta'):
     etc_coverage_df_rows = list()
+    genome_ids = get_ids_from_annotations_by_group(annotations, groupby_column)
     for _, module_row in etc_module_df.iterrows():
         definition = module_row['definition']
         # remove optional subunits
@@ -453,9 +487,9 @@ def make_etc_coverage_df(etc_module_df, annotations, groupby_column='fasta'):
         for node in no_out:
             module_net.add_edge(node, 'end')
         # go through each genome and check pathway coverage
-        for group, frame in annotations.groupby(groupby_column):
+        for group in sorted(genome_ids):
             # get annotation genes
-            grouped_ids = set(get_ids_from_annotations_all(frame).keys())
+            grouped_ids = set(genome_ids[group].keys())
             path_len, path_coverage_count, path_coverage_percent, genes, missing_genes = \
                 get_module_coverage(module_net, grouped_ids)
             complex_module_name = 'Complex %s: %s' % (module_row['complex'].replace('Complex ', ''),
@@ -497,10 +531,8 @@ def make_functional_df(annotations, function_heatmap_form, logger, groupby_colum
     function_heatmap_form = function_heatmap_form.apply(lambda x: x.str.strip() if x.dtype == "object" else x)
     function_heatmap_form = function_heatmap_form.fillna('')
     # build dict of ids per genome
-    genome_to_id_dict = dict()
-    for genome, frame in annotations.groupby(groupby_column, sort=False):
-        id_list = get_ids_from_annotations_all(frame).keys()
-        genome_to_id_dict[genome] = set(id_list)
+    genome_to_id_dict = {genome: set(id_dict.keys()) for genome, id_dict in
+                         get_ids_from_annotations_by_group(annotations, groupby_column).items()}
     # build long from data frame
     rows = list()
     for function, frame in function_heatmap_form.groupby('function_name', sort=False):
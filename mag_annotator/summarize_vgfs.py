@@ -12,8 +12,7 @@ import altair as alt
 
 from mag_annotator.database_handler import DatabaseHandler
 from mag_annotator.utils import setup_logger
-from mag_annotator.summarize_genomes import get_ids_from_annotations_by_row, \
-    get_ids_from_annotations_all, get_ordered_uniques, check_columns
+from mag_annotator.summarize_genomes import get_ids_from_annotations_by_row, get_ordered_uniques, check_columns
 
 VOGDB_TYPE_NAMES = {'Xr': 'Viral replication genes', 'Xs': 'Viral structure genes',
                     'Xh': 'Viral genes with host benefits', 'Xp': 'Viral genes with viral benefits',
@@ -33,11 +32,10 @@ def add_custom_ms(annotations, distillate_form):
     metabolic_genes = set(distillate_form.index)
 
     new_amg_flags = list()
-    for gene, row in annotations.iterrows():
+    for (gene, row), gene_annotations in zip(annotations.iterrows(), get_ids_from_annotations_by_row(annotations)):
         if 'M' in row['amg_flags']:
             new_amg_flags.append(row['amg_flags'])
         else:
-            gene_annotations = set(get_ids_from_annotations_all(pd.DataFrame(row).transpose()).keys())
             if len(metabolic_genes & gene_annotations) > 0:
                 new_amg_flags.append(row['amg_flags'] + 'M')
             else:
@@ -156,8 +154,9 @@ def make_amg_count_column(potential_amgs, vgf_order=None):
 def make_viral_functional_df(annotations, genome_summary_form, groupby_column='scaffold'):
     # build dict of ids per genome
     vgf_to_id_dict = defaultdict(defaultdict_list)
-    for vgf, frame in annotations.groupby(groupby_column, sort=False):
-        for gene, id_list in get_ids_from_annotations_by_row(frame).items():
+    row_ids = get_ids_from_annotations_by_row(annotations)
+    for vgf, frame_ids in row_ids.groupby(annotations[groupby_column].to_numpy(), sort=False):
+        for gene, id_list in frame_ids.items():
             for id_ in id_list:
                 vgf_to_id_dict[vgf][id_].append(gene)
     # build long from data frame
@@ -1,12 +1,33 @@
 import re
+import shutil
 import subprocess
-from os import path, stat
-from urllib.request import urlopen, urlretrieve
-from urllib.error import URLError
+import sys
+from tempfile import TemporaryFile
+from os import path, stat, fstat, SEEK_END
+try:
+    from os import sendfile
+except ImportError:
+    sendfile = None
+try:
+    from os import posix_fadvise, POSIX_FADV_WILLNEED
+except ImportError:
+    posix_fadvise = None
+from time import sleep
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.request import urlopen
+from urllib.error import URLError, HTTPError
 import pandas as pd
 import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
+import atexit
 from typing import Callable
 
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 HMMSCAN_ALL_COLUMNS = ['query_id', 'query_ascession', 'query_length', 'target_id', 'target_ascession', 'target_length',
                        'full_evalue', 'full_score', 'full_bias', 'domain_number', 'domain_count', 'domain_cevalue',
                        'domain_ievalue', 'domain_score', 'domain_bias', 'target_start', 'target_end', 'alignment_start',
@@ -15,47 +36,131 @@ HMMSCAN_COLUMN_TYPES = [str, str, int, str, str, int, float, float, float, int,
                         int, int, int, int, int, float, str]
 BOUTFMT6_COLUMNS = ['qId', 'tId', 'seqIdentity', 'alnLen', 'mismatchCnt', 'gapOpenCnt', 'qStart', 'qEnd', 'tStart',
                     'tEnd', 'eVal', 'bitScore']
+DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 0.5
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+DOWNLOAD_WORKERS = 4
+MERGE_PREFETCH_DEPTH = 32
+MERGE_PREFETCH_MIN_FILES = 4
 
 
 def download_file(url: str, output_file: str, logger: logging.Logger, alt_urls: list = None, verbose = True):
-    # TODO: catching error 4 and give error message to retry or retry automatically
+    """Download a url to a file, streaming it in chunks. Failed downloads are retried with a backoff before moving on
+    to the alternative urls."""
     links = [url] if alt_urls is None else [url] + alt_urls
     for l in links: 
         if verbose:
-            print('downloading %s' % url)
-        try:
-            urlretrieve(l, output_file)
-            return
-        except BaseException as error:
-            # BaseException is good http was to exact
-            logger.warning(f"Something went wrong with the download of the url: {l}")
-            logger.warning(error)
+            logger.info('downloading %s', l)
+        for attempt in range(DOWNLOAD_RETRIES):
+            try:
+                with urlopen(l, timeout=DOWNLOAD_TIMEOUT) as response, open(output_file, 'wb') as out:
+                    shutil.copyfileobj(response, out, DOWNLOAD_CHUNK_SIZE)
+                return
+            except Exception as error:
+                # Exception is good http was to exact
+                logger.warning(f"Something went wrong with the download of the url: {l}")
+                logger.warning(error)
+                # a missing page won't come back by asking again
+                if isinstance(error, HTTPError) and error.code < 500:
+                    break
+                if attempt + 1 < DOWNLOAD_RETRIES:
+                    sleep(DOWNLOAD_BACKOFF * 2 ** attempt)
     raise URLError("DRAM whas not able to download a key database, check the logg for details")
     # run_process(['wget', '-O', output_file, url], verbose=verbose)
 
 
+def download_files(downloads: list, logger: logging.Logger, max_workers: int = DOWNLOAD_WORKERS, verbose=True):
+    """Download several files at once, each download is a (url, output_file) or (url, output_file, alt_urls) tuple.
+    Keep max_workers small so mirrors don't rate limit us. Returns the output files in the order given."""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict()
+        for download in downloads:
+            url, output_file = download[0], download[1]
+            alt_urls = download[2] if len(download) > 2 else None
+            futures[executor.submit(download_file, url, output_file, logger, alt_urls=alt_urls,
+                                    verbose=verbose)] = output_file
+        for done, future in enumerate(as_completed(futures)):
+            future.result()
+            logger.info(f"Downloaded {futures[future]} ({done + 1}/{len(futures)})")
+    return [i[1] for i in downloads]
+
+
+# one console handler and one queue listener per logger, so calling setup_logger again adds file handlers instead of
+# duplicate console output and threads
+LOG_CONSOLE_HANDLERS = dict()
+LOG_LISTENERS = dict()
+RUNNING_LOG_LISTENERS = set()
+
+
 def setup_logger(logger, *log_file_paths, level=logging.INFO):
+    """Log to the console and to each of the log files. The console is written to straight away so it stays in order
+    with everything else printed, the log files are written on a background thread fed by a queue so logging calls
+    don't wait on disk I/O. Returns the queue listener, or None when there are no log files, it is stopped at exit so
+    nothing queued is lost. Calling this again for the same logger only adds the log files not already written to.
+    """
     logger.setLevel(level)
     formatter = logging.Formatter('%(asctime)s - %(message)s')
-    # create console handler
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.INFO)
-    # create formatter and add it to the handlers
-    ch.setFormatter(formatter)
-    logger.addHandler(ch)
+    ch = LOG_CONSOLE_HANDLERS.get(logger)
+    if ch is None:
+        # create console handler
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.INFO)
+        # create formatter and add it to the handlers
+        ch.setFormatter(formatter)
+        logger.addHandler(ch)
+        LOG_CONSOLE_HANDLERS[logger] = ch
+    else:
+        # log to whatever stderr is now, the old one may have been swapped out and closed so it is not flushed
+        with ch.lock:
+            ch.stream = sys.stderr
+    listener = LOG_LISTENERS.get(logger)
+    if listener is None:
+        if len(log_file_paths) == 0:
+            return None
+        # add the file handlers to the logger through the queue
+        log_queue = Queue(-1)
+        listener = QueueListener(log_queue, respect_handler_level=True)
+        logger.addHandler(QueueHandler(log_queue))
+        LOG_LISTENERS[logger] = listener
+    logged_to = {i.baseFilename for i in listener.handlers}
     for log_file_path in log_file_paths:
+        if path.abspath(log_file_path) in logged_to:
+            continue
         fh = logging.FileHandler(log_file_path)
         fh.setLevel(logging.INFO)
         fh.setFormatter(formatter)
-        # add the handlers to the logger
-        logger.addHandler(fh)
+        listener.handlers += (fh,)
+        logged_to.add(fh.baseFilename)
+    if listener not in RUNNING_LOG_LISTENERS:
+        listener.start()
+        RUNNING_LOG_LISTENERS.add(listener)
+    return listener
+
+
+def stop_log_listener(listener):
+    """Write out the records still queued and stop the listener thread, safe to call more than once"""
+    if listener in RUNNING_LOG_LISTENERS:
+        RUNNING_LOG_LISTENERS.discard(listener)
+        listener.stop()
+
+
+@atexit.register
+def stop_log_listeners():
+    for listener in list(RUNNING_LOG_LISTENERS):
+        stop_log_listener(listener)
 
 
 def run_process(command, logger, shell:bool=False, capture_stdout:bool=True, save_output:str=None, 
-                check:bool=False, stop_on_error:bool=True, verbose:bool=False) -> str:
+                check:bool=False, stop_on_error:bool=True, verbose:bool=False, line_callback:Callable=None) -> str:
     """
     Standardization of parameters for using subprocess.run, provides verbose mode and option to run via shell
+    If save_output or line_callback are given the output is streamed, see stream_process
+    verbose is kept for the callers that pass it, it does not change what is run or logged
     """
+    if save_output is not None or line_callback is not None:
+        return stream_process(command, logger, shell=shell, capture_stdout=capture_stdout, save_output=save_output,
+                              check=check, stop_on_error=stop_on_error, line_callback=line_callback)
     # TODO just remove check
     try:
         results = subprocess.run(command, check=check, shell=shell,
@@ -69,13 +174,55 @@ def run_process(command, logger, shell:bool=False, capture_stdout:bool=True, sav
         logging.debug(results.stdout)
         if stop_on_error:
            raise subprocess.SubprocessError(f"The subcommand {' '.join(command)} experienced an error, see the log for more info.")
-    if save_output is not None:
-        with open(save_output, 'w') as out:
-            out.write(results.stdout)
     if capture_stdout:
         return results.stdout
 
 
+def stream_process(command, logger, shell:bool=False, capture_stdout:bool=True, save_output:str=None,
+                   check:bool=False, stop_on_error:bool=True, line_callback:Callable=None, ok_returncodes:tuple=(0,),
+                   encoding:str=None, errors:str=None) -> str:
+    """
+    Run a command and hand its stdout on line by line as it is produced, writing it to save_output and/or passing it
+    to line_callback. The whole stdout is only held in memory if capture_stdout is set. When stdout is only saved the
+    command writes straight to save_output and python never reads it.
+    Return codes in ok_returncodes are not treated as errors, with check set other return codes raise
+    CalledProcessError as subprocess.run would. encoding and errors are used to decode stdout.
+    """
+    captured = list()
+    read_lines = line_callback is not None or capture_stdout
+    out = open(save_output, 'w') if save_output is not None else None
+    if read_lines:
+        stdout = subprocess.PIPE
+    else:
+        stdout = out if out is not None else subprocess.DEVNULL
+    try:
+        # stderr goes to a file so a chatty command can't fill the pipe and block while stdout is read
+        with TemporaryFile('w+') as stderr:
+            with subprocess.Popen(command, shell=shell, stdout=stdout, stderr=stderr, text=True,
+                                  encoding=encoding, errors=errors, bufsize=1 << 20) as process:
+                if read_lines:
+                    for line in process.stdout:
+                        if out is not None:
+                            out.write(line)
+                        if line_callback is not None:
+                            line_callback(line)
+                        if capture_stdout:
+                            captured.append(line)
+            stderr.seek(0)
+            error = stderr.read()
+    finally:
+        if out is not None:
+            out.close()
+    if process.returncode not in ok_returncodes:
+        logger.critical(f'The subcommand {command} experienced an error: {error}')
+        if stop_on_error:
+            if check:
+                raise subprocess.CalledProcessError(process.returncode, command, stderr=error)
+            raise subprocess.SubprocessError(f"The subcommand {' '.join(command)} experienced an error, see the log for more info.")
+    if capture_stdout:
+        return ''.join(captured)
+
+
 # TODO: refactor following to methods to a shared run hmm step and individual get description steps
 def parse_hmmsearch_domtblout(file):
     df_lines = list()
@@ -98,29 +245,142 @@ def make_mmseqs_db(fasta_loc, output_loc, logger, create_index=True, threads=10,
         run_process(['mmseqs', 'createindex', output_loc, tmp_dir, '--threads', str(threads)], logger, verbose=verbose)
 
 
+def aho_corasick_grep(search_terms, search_against, chunk_size=1 << 24):
+    """Get the lines of a file containing any of the search terms, the same lines that grep -a -F would return
+    The lines are yielded one at a time as they are found, decoded as utf-8 with bad bytes replaced, so the matches are
+    never all held in memory at once
+    """
+    if ahocorasick is None:
+        raise ImportError("aho_corasick_grep needs the optional pyahocorasick package, install it or use multigrep "
+                          "which falls back to grep")
+    automaton = ahocorasick.Automaton()
+    for term in search_terms:
+        # latin-1 maps every byte to a single character so matching works on arbitrary binary data
+        term = term.encode().decode('latin-1')
+        automaton.add_word(term, term)
+    if len(automaton) == 0:
+        return iter(())
+    automaton.make_automaton()
+    return iter_matched_lines(automaton, search_against, chunk_size)
+
+
+def iter_matched_lines(automaton, search_against, chunk_size):
+    with open(search_against, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            chunk = (chunk + f.readline()).decode('latin-1')
+            last_line_start = -1
+            for end, _ in automaton.iter(chunk):
+                line_start = chunk.rfind('\n', 0, end) + 1
+                if line_start == last_line_start:
+                    continue
+                last_line_start = line_start
+                line_end = chunk.find('\n', end)
+                line_end = line_end if line_end != -1 else len(chunk)
+                # lines split on a new line byte, which is never part of a multi byte character, so each decodes alone
+                yield '%s\n' % chunk[line_start:line_end].encode('latin-1').decode(errors='replace')
+
+
+def add_multigrep_entries(entries, found):
+    for entry in entries:
+        entry = entry.strip()
+        if len(entry) > 0:
+            found[entry.split()[0]] = entry
+
+
 def multigrep(search_terms, search_against, logger, split_char='\n', output='.'):
     # TODO: multiprocess this over the list of search terms
-    """Search a list of exact substrings against a database, takes name of mmseqs db index with _h to search against"""
+    """Search a list of exact substrings against a database, takes name of mmseqs db index with _h to search against
+    Uses an Aho-Corasick automaton if pyahocorasick is installed, falls back to ripgrep or grep otherwise
+    """
+    found = dict()
+    # an empty term would match every line, duplicates only add work
+    search_terms = sorted({i for i in search_terms if len(i) > 0}, key=lambda x: (-len(x), x))
+    if len(search_terms) == 0:
+        return found
+    # entries can end mid line when split_char is not a new line, so the unfinished end of each line is carried over
+    remainder = ''
+
+    def add_line(line):
+        nonlocal remainder
+        *entries, remainder = (remainder + line).split(split_char)
+        add_multigrep_entries(entries, found)
+
+    if ahocorasick is not None:
+        for line in aho_corasick_grep(search_terms, search_against):
+            add_line(line)
+        add_multigrep_entries([remainder], found)
+        return found
     hits_file = path.join(output, 'hits.txt')
     with open(hits_file, 'w') as f:
         f.write('%s\n' % '\n'.join(search_terms))
-    results = run_process(['grep', '-a', '-F', '-f', hits_file, search_against], logger, capture_stdout=True, verbose=False)
-    processed_results = [i.strip() for i in results.strip().split(split_char)
-                         if len(i) > 0]
+    if shutil.which('rg') is not None:
+        # ripgrep returns the same lines as grep -a -F but matches many literals faster, it searches a single file on
+        # one thread so there is no point asking for more
+        command = ['rg', '--no-config', '-a', '-F', '--no-filename', '--no-line-number', '-f', hits_file,
+                   search_against]
+    else:
+        command = ['grep', '-a', '-F', '-f', hits_file, search_against]
+    # grep exits with 1 when nothing matches, that is no hits rather than an error, and bytes that are not valid utf-8
+    # are replaced the same way aho_corasick_grep does
+    stream_process(command, logger, capture_stdout=False, line_callback=add_line, ok_returncodes=(0, 1),
+                   encoding='utf-8', errors='replace')
+    add_multigrep_entries([remainder], found)
     # remove(hits_file)
-    return {i.split()[0]: i for i in processed_results if i != ''}
+    return found
+
+
+def copy_remaining(in_handle, out_handle, chunk_size=1 << 20):
+    """Copy the rest of an open binary file to another, in kernel space with sendfile when the platform allows it"""
+    offset = in_handle.tell()
+    size = fstat(in_handle.fileno()).st_size
+    out_handle.flush()
+    try:
+        if sendfile is None:
+            raise OSError('sendfile is not available on this platform')
+        while offset < size:
+            sent = sendfile(out_handle.fileno(), in_handle.fileno(), offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+    except OSError:
+        # sendfile is not supported here, copy through a bounded buffer instead
+        in_handle.seek(offset)
+        out_handle.seek(0, SEEK_END)
+        shutil.copyfileobj(in_handle, out_handle, chunk_size)
+
+
+def prefetch_file(file):
+    """Ask the kernel to start reading a file into the page cache, does nothing where posix_fadvise is unavailable"""
+    if posix_fadvise is None:
+        return
+    try:
+        with open(file, 'rb') as f:
+            posix_fadvise(f.fileno(), 0, 0, POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
 
 
 def merge_files(files_to_merge, outfile, has_header=False):
-    """It's in the name, if has_header assumes all files have the same header"""
-    with open(outfile, 'w') as outfile_handle:
+    """It's in the name, if has_header assumes all files have the same header
+    When merging many files the next MERGE_PREFETCH_DEPTH files are prefetched so reads overlap with the copying
+    """
+    prefetch_depth = MERGE_PREFETCH_DEPTH if len(files_to_merge) >= MERGE_PREFETCH_MIN_FILES else 0
+    for file in files_to_merge[:prefetch_depth]:
+        prefetch_file(file)
+    with open(outfile, 'wb') as outfile_handle:
         if has_header:
-            outfile_handle.write(open(files_to_merge[0]).readline())
-        for file in files_to_merge:
-            with open(file) as f:
+            with open(files_to_merge[0], 'rb') as f:
+                outfile_handle.write(f.readline())
+        for i, file in enumerate(files_to_merge):
+            if prefetch_depth > 0 and i + prefetch_depth < len(files_to_merge):
+                prefetch_file(files_to_merge[i + prefetch_depth])
+            with open(file, 'rb') as f:
                 if has_header:
                     _ = f.readline()
-                outfile_handle.write(f.read())
+                copy_remaining(f, outfile_handle)
 
 
 def divide_chunks(l, n):
@@ -129,22 +389,27 @@ def divide_chunks(l, n):
         yield l[i:i + n]
 
 
-def remove_prefix(text, prefix):
-    if text.startswith(prefix):
-        return text[len(prefix):]
-    return text  # or whatever
-
+if sys.version_info >= (3, 9):
+    remove_prefix = str.removeprefix
+    remove_suffix = str.removesuffix
+else:
+    def remove_prefix(text, prefix):
+        if text.startswith(prefix):
+            return text[len(prefix):]
+        return text  # or whatever
 
-def remove_suffix(text, suffix):
-    if text.endswith(suffix):
-        return text[:-1*len(suffix)]
-    return text  # or whatever
+    def remove_suffix(text, suffix):
+        if suffix and text.endswith(suffix):
+            return text[:-1*len(suffix)]
+        return text  # or whatever
 
 
 def get_ordered_uniques(seq):
-    seen = set()
-    seen_add = seen.add
-    return [x for x in seq if not (x in seen or seen_add(x) or pd.isna(x))]
+    """Unique values of seq in the order they first appear, missing values are dropped"""
+    if isinstance(seq, pd.Series):
+        return list(dict.fromkeys(seq.dropna()))
+    # only the unique values need to be checked for missing values
+    return [x for x in dict.fromkeys(seq) if not pd.isna(x)]
 
 
 def get_best_hits(query_db, target_db, logger, output_dir='.', query_prefix='query', target_prefix='target',
@@ -3,6 +3,7 @@ import pytest
 import os
 import logging
 import pandas as pd
+from collections import Counter
 import networkx as nx
 import altair as alt
 
@@ -11,7 +12,8 @@ from mag_annotator.summarize_genomes import fill_genome_summary_frame, summarize
     make_module_coverage_heatmap, pairwise, first_open_paren_is_all, split_into_steps, is_ko, make_module_network, \
     get_module_coverage, make_etc_coverage_df, make_etc_coverage_heatmap, make_functional_df, make_functional_heatmap, \
     fill_liquor_dfs, make_liquor_heatmap, make_liquor_df, make_genome_summary, write_summarized_genomes_to_xlsx,\
-    get_phylum_and_most_specific, get_ids_from_annotations_all, get_ids_from_annotations_by_row
+    get_phylum_and_most_specific, get_ids_from_annotations_all, get_ids_from_annotations_by_row, \
+    get_ids_from_annotations_by_group
 from mag_annotator.utils import get_ordered_uniques, setup_logger
 
 
@@ -19,6 +21,8 @@ def test_get_ordered_uniques():
     assert get_ordered_uniques([1, 2, 3]) == [1, 2, 3]
     assert get_ordered_uniques([1, 1, 2, 3]) == [1, 2, 3]
     assert get_ordered_uniques([1, 2, 1, 3]) == [1, 2, 3]
+    assert get_ordered_uniques(['b', None, 'a', 'b', pd.np.NaN]) == ['b', 'a']
+    assert get_ordered_uniques(pd.Series(['b', 'a', pd.np.NaN, 'b'])) == ['b', 'a']
 
 
 @pytest.fixture()
@@ -63,6 +67,26 @@ def test_get_ids_from_row(logger):
     assert out_data['id_set4'] == {'GH4'}
 
 
+def test_get_ids_from_annotations_all():
+    in_data = pd.DataFrame({'ko_id': ['K00001,K00003', 'K00001', pd.np.NaN],
+                            'pfam_hits': ['Some pfam [PF00001.2]', pd.np.NaN, 'Another [PF00001.3]'],
+                            'methyl_id': ['K00001 methyl description', pd.np.NaN, pd.np.NaN]},
+                           index=['gene1', 'gene2', 'gene3'])
+    out_data = get_ids_from_annotations_all(in_data)
+    assert out_data == Counter({'K00001': 2, 'K00003': 1, 'PF00001': 2})
+
+
+def test_get_ids_from_annotations_by_group():
+    in_data = pd.DataFrame({'fasta': ['genome2', 'genome1', 'genome2', 'genome3'],
+                            'ko_id': ['K00001,K00003', 'K00001', 'K00001', pd.np.NaN]},
+                           index=['gene1', 'gene2', 'gene3', 'gene4'])
+    out_data = get_ids_from_annotations_by_group(in_data, 'fasta')
+    assert list(out_data.keys()) == ['genome2', 'genome1', 'genome3']
+    assert out_data['genome2'] == Counter({'K00001': 2, 'K00003': 1})
+    assert out_data['genome1'] == Counter({'K00001': 1})
+    assert out_data['genome3'] == Counter()
+
+
 def test_fill_genome_summary_frame(annotations, genome_summary_frame, summarized_genomes, logger):
     test_frame = fill_genome_summary_frame(annotations, genome_summary_frame, 'fasta', logger)
     pd.testing.assert_frame_equal(test_frame, summarized_genomes)
@@ -3,7 +3,7 @@ import pytest
 import pandas as pd
 import altair as alt
 
-from mag_annotator.summarize_vgfs import filter_to_amgs, get_strand_switches, make_viral_distillate, make_vgf_order, \
+from mag_annotator.summarize_vgfs import add_custom_ms, filter_to_amgs, get_strand_switches, make_viral_distillate, make_vgf_order, \
     make_amg_count_column, make_viral_functional_df, make_viral_functional_heatmap
 
 
@@ -25,6 +25,11 @@ def pamgs():
                         columns=['scaffold', 'ko_id', 'amg_flags', 'auxiliary_score'])
 
 
+def test_add_custom_ms(annotations):
+    distillate_form = pd.DataFrame(index=['K99999', 'K12345'])
+    assert add_custom_ms(annotations, distillate_form) == ['VTFM', 'M', 'MFTJ', 'MKE']
+
+
 def test_filter_to_amgs(annotations, pamgs):
     test_pamgs = filter_to_amgs(annotations, remove_transposons=False, max_aux=3)
     pd.testing.assert_frame_equal(test_pamgs, pamgs)
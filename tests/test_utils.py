@@ -2,12 +2,15 @@ import pytest
 
 import os
 import json
+import subprocess
 import pandas as pd
 import logging
+from logging.handlers import QueueHandler
 
 from mag_annotator.utils import run_process, make_mmseqs_db, \
-    merge_files, multigrep, remove_prefix, remove_suffix, \
-    setup_logger, parse_hmmsearch_domtblout, generic_hmmscan_formater, download_file
+    merge_files, multigrep, aho_corasick_grep, remove_prefix, remove_suffix, \
+    setup_logger, stop_log_listener, parse_hmmsearch_domtblout, generic_hmmscan_formater, download_file, \
+    download_files
 from mag_annotator.pull_sequences import get_genes_from_identifiers
 
 @pytest.fixture()
@@ -17,11 +20,73 @@ def logger(tmpdir):
     return logger
 
 
+def test_setup_logger(tmpdir):
+    log_file = str(tmpdir.join('test_setup_logger.log'))
+    logger = logging.getLogger('test_setup_logger')
+    listener = setup_logger(logger, log_file)
+    logger.info('a message for %s', 'the log')
+    logger.debug('a message that is filtered out')
+    stop_log_listener(listener)
+    stop_log_listener(listener)
+    with open(log_file) as f:
+        lines = f.readlines()
+    assert len(lines) == 1
+    assert lines[0].endswith(' - a message for the log\n')
+
+
+def test_setup_logger_repeated(tmpdir):
+    log_file = str(tmpdir.join('test_setup_logger_repeated.log'))
+    second_log_file = str(tmpdir.join('test_setup_logger_repeated_second.log'))
+    logger = logging.getLogger('test_setup_logger_repeated')
+    listener = setup_logger(logger, log_file)
+    assert setup_logger(logger, log_file) is listener
+    assert setup_logger(logger, second_log_file) is listener
+    assert len([i for i in logger.handlers if isinstance(i, QueueHandler)]) == 1
+    assert len([i for i in logger.handlers if type(i) is logging.StreamHandler]) == 1
+    logger.info('a message')
+    stop_log_listener(listener)
+    for i in log_file, second_log_file:
+        with open(i) as f:
+            assert len(f.readlines()) == 1
+    # a stopped listener starts again when the logger is set up again
+    assert setup_logger(logger) is listener
+    logger.info('another message')
+    stop_log_listener(listener)
+    with open(log_file) as f:
+        assert len(f.readlines()) == 2
+
+
+@pytest.mark.parametrize('message', ['first message', 'second message'])
+def test_setup_logger_console(capsys, message):
+    # both runs share the logger, the second one must not touch the stderr captured and closed by the first
+    logger = logging.getLogger('test_setup_logger_console')
+    assert setup_logger(logger) is None
+    logger.info(message)
+    assert capsys.readouterr().err.endswith(' - %s\n' % message)
+
+
 def test_run_process(logger):
     run_process(['echo', 'Hello', 'World'], logger, verbose=True)
     assert True
 
 
+def test_run_process_streaming(logger, tmpdir):
+    output_file = str(tmpdir.join('run_process_streaming.txt'))
+    lines = list()
+    stdout = run_process(['printf', 'Hello\\nWorld\\n'], logger, save_output=output_file, line_callback=lines.append)
+    assert stdout == 'Hello\nWorld\n'
+    assert lines == ['Hello\n', 'World\n']
+    with open(output_file) as f:
+        assert f.read() == 'Hello\nWorld\n'
+    assert run_process(['echo', 'Hello'], logger, capture_stdout=False, save_output=output_file) is None
+    with open(output_file) as f:
+        assert f.read() == 'Hello\n'
+    with pytest.raises(subprocess.SubprocessError):
+        run_process(['false'], logger, line_callback=lines.append)
+    with pytest.raises(subprocess.CalledProcessError):
+        run_process(['false'], logger, capture_stdout=False, save_output=output_file, check=True)
+
+
 @pytest.fixture()
 def mmseqs_db_dir(tmpdir):
     output_loc = tmpdir.mkdir('make_mmseqs_db_test')
@@ -82,6 +147,31 @@ def test_download_file(logger, tmpdir):
                             'function_heatmap_form.tsv'])
     assert os.stat(tempfile).st_size > 0
 
+def test_download_file_local(logger, tmpdir):
+    source = tmpdir / 'source.tsv'
+    source.write('gene_id\tgene_description\n' * 1000)
+    tempfile = tmpdir / 'out'
+    download_file('file://%s' % source, tempfile, logger, verbose=False)
+    assert tempfile.read() == source.read()
+
+
+def test_download_files(logger, tmpdir):
+    downloads = list()
+    for i in range(5):
+        source = tmpdir / ('source_%s.tsv' % i)
+        source.write('gene_id\n%s\n' % i)
+        downloads.append(('file://%s' % source, str(tmpdir / ('out_%s' % i))))
+    output_files = download_files(downloads, logger, max_workers=2, verbose=False)
+    assert output_files == [i[1] for i in downloads]
+    for i in range(5):
+        assert (tmpdir / ('out_%s' % i)).read() == 'gene_id\n%s\n' % i
+    # the third item is the list of alternative urls
+    alt_download = ('file://%s' % (tmpdir / 'missing.tsv'), str(tmpdir / 'out_alt'),
+                    ['file://%s' % (tmpdir / 'source_0.tsv')])
+    assert download_files([alt_download], logger, verbose=False) == [str(tmpdir / 'out_alt')]
+    assert (tmpdir / 'out_alt').read() == 'gene_id\n0\n'
+
+
 def test_merge_files(files_to_merge_no_header, files_to_merge_w_header, merge_test_dir):
     test_merge = merge_test_dir.join('merged_test.txt')
     merge_files(files_to_merge_no_header, test_merge, False)
@@ -92,6 +182,17 @@ def test_merge_files(files_to_merge_no_header, files_to_merge_w_header, merge_te
     assert len(test_merge_w_header.readlines()) == 4
 
 
+def test_merge_files_many(merge_test_dir):
+    files_to_merge = list()
+    for i in range(10):
+        merge_file = merge_test_dir.join('merge_test_many.%s.txt' % str(i))
+        merge_file.write('gene_name\ntest%s\n' % str(i))
+        files_to_merge.append(merge_file)
+    test_merge = merge_test_dir.join('merged_test_many.txt')
+    merge_files(files_to_merge, test_merge, True)
+    assert test_merge.read() == 'gene_name\n%s' % ''.join('test%s\n' % str(i) for i in range(10))
+
+
 @pytest.fixture()
 def multigrep_inputs(tmpdir):
     hits = ['gene1', 'gene3', 'gene5']
@@ -144,6 +245,68 @@ def test_multigrep(multigrep_inputs, logger):
     assert dict_['gene1'] == 'gene1 something about gene1'
     assert dict_['gene3'] == 'gene3 data including gene3'
     assert dict_['gene5'] == 'gene5 data including gene5'
+    assert multigrep(keys + keys + [''], values, logger) == dict_
+    assert multigrep([], values, logger) == dict()
+
+
+def test_aho_corasick_grep_missing(tmpdir, monkeypatch):
+    monkeypatch.setattr('mag_annotator.utils.ahocorasick', None)
+    with pytest.raises(ImportError):
+        aho_corasick_grep(['gene1'], str(tmpdir.join('missing')))
+
+
+def test_multigrep_grep(multigrep_inputs, logger, tmpdir, monkeypatch):
+    monkeypatch.setattr('mag_annotator.utils.ahocorasick', None)
+    keys, values = multigrep_inputs
+    dict_ = multigrep(keys + ['gene1', ''], values, logger, output=str(tmpdir))
+    assert len(dict_) == len(keys)
+    assert (tmpdir / 'hits.txt').read() == 'gene1\ngene3\ngene5\n'
+    assert dict_['gene3'] == 'gene3 data including gene3'
+    mmseqs_headers = tmpdir.join('multigrep_test_headers')
+    mmseqs_headers.write_binary(b'gene1 about gene1\n\x00gene2 about gene2\n\x00gene3 about gene3\n\x00')
+    dict_ = multigrep(['gene1', 'gene3'], str(mmseqs_headers), logger, '\x00', str(tmpdir))
+    assert dict_ == {'gene1': 'gene1 about gene1', 'gene3': 'gene3 about gene3'}
+
+
+@pytest.mark.parametrize('rg_path, program', [('/usr/bin/rg', 'rg'), (None, 'grep')])
+def test_multigrep_command(logger, tmpdir, monkeypatch, rg_path, program):
+    monkeypatch.setattr('mag_annotator.utils.ahocorasick', None)
+    monkeypatch.setattr('mag_annotator.utils.shutil.which', lambda name: rg_path)
+    commands = list()
+
+    def fake_stream_process(command, logger, line_callback=None, **kwargs):
+        commands.append(command)
+        line_callback('gene1 about gene1\n')
+
+    monkeypatch.setattr('mag_annotator.utils.stream_process', fake_stream_process)
+    hits_file = str(tmpdir.join('hits.txt'))
+    assert multigrep(['gene1'], 'headers', logger, output=str(tmpdir)) == {'gene1': 'gene1 about gene1'}
+    if program == 'rg':
+        assert commands == [['rg', '--no-config', '-a', '-F', '--no-filename', '--no-line-number', '-f', hits_file,
+                             'headers']]
+    else:
+        assert commands == [['grep', '-a', '-F', '-f', hits_file, 'headers']]
+
+
+@pytest.mark.parametrize('use_ahocorasick', [True, False])
+def test_multigrep_backends_agree(logger, tmpdir, monkeypatch, use_ahocorasick):
+    if use_ahocorasick:
+        pytest.importorskip('ahocorasick')
+    else:
+        monkeypatch.setattr('mag_annotator.utils.ahocorasick', None)
+    data_file = tmpdir.join('multigrep_backend_data')
+    data_file.write_binary(b'gene1 about \xff gene1\ngene2 about gene2\n')
+    assert multigrep(['gene4'], str(data_file), logger, output=str(tmpdir)) == dict()
+    assert multigrep(['gene1'], str(data_file), logger, output=str(tmpdir)) == {'gene1': 'gene1 about \ufffd gene1'}
+
+
+def test_aho_corasick_grep(tmpdir):
+    pytest.importorskip('ahocorasick')
+    data_file = tmpdir.join('aho_corasick_grep_test_data')
+    data_file.write_binary(b'gene1 about gene1\n\x00gene2 about gene2\n\x00gene3 about gene3 and gene1\n\x00')
+    matched = aho_corasick_grep(['gene1', 'gene2'], str(data_file), chunk_size=4)
+    assert list(matched) == ['gene1 about gene1\n', '\x00gene2 about gene2\n', '\x00gene3 about gene3 and gene1\n']
+    assert list(aho_corasick_grep(['gene4'], str(data_file))) == []
 
 
 def test_remove_prefix():
@@ -159,6 +322,7 @@ def test_remove_prefix():
 def test_remove_suffix():
     assert remove_suffix('suffix', 'fix') == 'suf'
     assert remove_suffix('postfix', 'suf') == 'postfix'
+    assert remove_suffix('postfix', '') == 'postfix'
 
 
 @pytest.fixture()